@@ -3,12 +3,42 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
+import asyncio
+import hashlib
+import logging
 import os
 import json
-import requests
-import litellm # Import litellm
+import time
+import httpx # Async HTTP client for Pexels calls
 import re # For regular expressions to parse paragraphs
 
+# litellm pulls in tokenizers and several HTTP stacks and costs a good
+# chunk of cold-start time on its own; import it on first use so startup
+# (and cache-hit requests) never pay for it.
+_litellm = None
+
+def _get_litellm():
+    global _litellm
+    if _litellm is None:
+        import litellm
+        _litellm = litellm
+    return _litellm
+
+try:
+    # orjson handles small payloads several times faster than stdlib json
+    import orjson
+    _json_loads = orjson.loads
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+# Module logger; print() would grab the stdout lock and flush on every
+# call, which serializes concurrent streams. Level is left to uvicorn's
+# logging config (use WARNING in production).
+logger = logging.getLogger(__name__)
+
 # --- Environment Variable Loading ---
 # Load environment variables from .env file
 load_dotenv()
@@ -30,37 +60,141 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Shared async HTTP client for Pexels. Created on startup and closed on
+# shutdown so connections are pooled/kept alive instead of re-handshaking
+# TCP+TLS on every image fetch, and so a blocking call never stalls the
+# event loop while other requests are streaming.
+http_client: httpx.AsyncClient | None = None
+
+# Cap concurrent upstream calls so a burst of /generate requests queues
+# briefly in-process instead of drawing 429s (which fail the whole
+# handler) from OpenRouter or Pexels.
+_llm_semaphore = asyncio.Semaphore(8)
+_pexels_semaphore = asyncio.Semaphore(5)
+
+@app.on_event("startup")
+async def startup_event():
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=5.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        # Authorize every Pexels call once, here, instead of per request
+        headers={"Authorization": PEXELS_API_KEY} if PEXELS_API_KEY else None,
+    )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if http_client:
+        await http_client.aclose()
+
 # Pydantic model for the request body
 class BlogRequest(BaseModel):
     prompt: str
 
-# --- Pexels Image Fetching (Modified to return single image URL) ---
-def fetch_single_image(query: str) -> str | None:
+# --- Pexels Image Fetching ---
+async def fetch_images(query: str, count: int = 1) -> list[str]:
     """
-    Fetches a single image URL from the Pexels API based on a given query.
-    Returns the URL of a 'large' or 'medium' size image, or None if not found/error.
+    Fetches up to `count` image URLs from the Pexels API in one search.
+    Returns 'large' size URLs (falling back to 'medium'), or an empty
+    list if nothing was found or the call failed.
     """
     if not PEXELS_API_KEY:
-        print("PEXELS_API_KEY not found. Skipping image fetch.")
-        return None
-    headers = {"Authorization": PEXELS_API_KEY}
-    # Fetch 1 image, prioritize landscape for blog layout
-    params = {"query": query, "per_page": 1, "orientation": "landscape"} 
+        logger.warning("PEXELS_API_KEY not found. Skipping image fetch.")
+        return []
+    cache_key = f"{query}|{count}"
+    cached = _pexels_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return list(cached[1])
+    # Prioritize landscape for blog layout
+    params = {"query": query, "per_page": count, "orientation": "landscape"}
     try:
-        res = requests.get("https://api.pexels.com/v1/search", headers=headers, params=params, timeout=5)
+        async with _pexels_semaphore:
+            res = await http_client.get("https://api.pexels.com/v1/search", params=params)
         res.raise_for_status() # Raise an exception for HTTP errors
         data = res.json()
-        if data.get('photos'):
+        image_urls = []
+        for photo in data.get('photos', []):
             # Prefer 'large' for higher quality, fallback to 'medium'
-            return data['photos'][0]['src'].get('large') or data['photos'][0]['src'].get('medium')
-        else:
-            return None
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching image from Pexels for query '{query}': {e}")
-        return None
+            image_url = photo['src'].get('large') or photo['src'].get('medium')
+            if image_url:
+                image_urls.append(image_url)
+        if image_urls:
+            # Only successful lookups are cached; failures get retried
+            _pexels_cache[cache_key] = (time.monotonic() + _PEXELS_CACHE_TTL, tuple(image_urls))
+            if len(_pexels_cache) > _PEXELS_CACHE_MAX_ENTRIES:
+                _pexels_cache.pop(next(iter(_pexels_cache)))
+        return image_urls
+    except httpx.HTTPError as e:
+        logger.warning("Error fetching images from Pexels for query '%s': %s", query, e)
+        return []
     except Exception as e:
-        print(f"An unexpected error occurred in fetch_single_image: {e}")
-        return None
+        logger.exception("An unexpected error occurred in fetch_images: %s", e)
+        return []
+
+# Limit the number of images to insert for demonstration
+MAX_IMAGES_TO_INSERT = 2
+
+# Splits blog text into paragraphs (one or more blank lines). Compiled
+# once at import instead of on every request.
+_PARAGRAPH_SPLIT = re.compile(r'\n\s*\n')
+
+# Start of the JSON keywords block the blog model appends to its reply,
+# and a pattern matching the whole block in one pass. Using a compiled
+# regex keeps the scan in C instead of walking the text in Python, and
+# tolerates trailing prose after the block.
+_IMAGES_MARKER = '{"images"'
+_IMAGES_BLOCK = re.compile(r'\{"images"\s*:\s*\[[^\]]*\]\s*\}')
+
+# Finished posts (text + image markdown) keyed by prompt hash, so a
+# repeated prompt skips the multi-second LLM round-trip entirely.
+# Oldest entry is evicted once the cap is reached to bound memory.
+_BLOG_CACHE_MAX_ENTRIES = 256
+_blog_cache: dict[str, str] = {}
+
+# Pexels results for a query are stable for hours, so popular keywords
+# ("ai", "technology", ...) shouldn't hit the API on every post. Maps
+# "query|count" -> (expiry timestamp, image URLs).
+_PEXELS_CACHE_TTL = 3600 # seconds
+_PEXELS_CACHE_MAX_ENTRIES = 2048
+_pexels_cache: dict[str, tuple[float, tuple[str, ...]]] = {}
+
+# Minimal stopword list for the local fallback keyword extractor
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can for from has have how if in into is it its "
+    "more most not of on or our so that the their them then there these they this "
+    "to was we what when where which who will with you your".split()
+)
+_WORD_RE = re.compile(r"[a-zA-Z]{3,}")
+
+def extract_fallback_keywords(text: str, top_n: int = 3) -> list[str]:
+    """
+    Picks the most frequent non-stopword terms from the generated text.
+    Used when the model omits the inline images block — runs locally in
+    well under a millisecond, no extra LLM round-trip.
+    """
+    counts: dict[str, int] = {}
+    for word in _WORD_RE.findall(text.lower()):
+        if word not in _STOPWORDS:
+            counts[word] = counts.get(word, 0) + 1
+    return sorted(counts, key=counts.get, reverse=True)[:top_n]
+
+async def sse_events(chunks):
+    """
+    Wraps raw text chunks as Server-Sent Events. Intermediaries (nginx,
+    Cloudflare) buffer plain-text responses, which would turn the stream
+    into one big chunk at the end; they pass text/event-stream through.
+    """
+    async for chunk in chunks:
+        yield f"data: {_json_dumps({'token': chunk})}\n\n"
+
+async def prepare_images(image_keywords: list[str]) -> list[str]:
+    """
+    Fetches images for the post with one combined Pexels search. A blog
+    post is about a single overall topic, so "ai education technology"
+    finds relevant images in one round-trip instead of one per keyword.
+    """
+    combined_query = " ".join(image_keywords[:3])
+    return await fetch_images(combined_query, count=MAX_IMAGES_TO_INSERT)
 
 # --- Streaming Blog Generator Endpoint (Updated with LiteLLM and Image Embedding) ---
 @app.post("/generate")
@@ -81,111 +215,173 @@ async def generate(request: BlogRequest):
             "You are a creative blog writer. Write a comprehensive, engaging, and well-structured blog post based on the given topic. "
             "Include an introduction, several main body paragraphs, and a conclusion. "
             "Use catchy headings (`##`), markdown for **bold** and *italic*, short paragraphs, and bullet points. "
-            "Use emojis 🎯 to make it more engaging. Focus on clear, concise writing."
+            "Use emojis 🎯 to make it more engaging. Focus on clear, concise writing. "
+            "At the very end of your reply, on a new line, output a JSON object "
+            "`{\"images\": [\"kw1\", \"kw2\", \"kw3\"]}` with 3 concise image search keywords for the post."
         )
     }
     conversation = [system_msg, {"role": "user", "content": user_prompt}]
 
+    # Same system prompt + same user prompt => same cached post
+    cache_key = hashlib.sha256(f"{system_msg['content']}|{user_prompt}".encode()).hexdigest()
+
     async def stream_generator():
-        full_blog_text = ""
-        image_keywords = [] # To store keywords for image fetching
+        blog_parts = [] # Streamed tokens; joined once when the stream ends
+        inserted_images = "" # Image markdown yielded after the text
+
+        cached = _blog_cache.get(cache_key)
+        if cached is not None:
+            logger.info("⚡ Serving blog from cache.")
+            # Chunked re-yield keeps the frontend's streaming UX intact
+            for i in range(0, len(cached), 512):
+                yield cached[i:i + 512]
+            return
 
-        print("🤖 Requesting blog content via LiteLLM...")
+        logger.info("🤖 Requesting blog content via LiteLLM...")
         try:
-            response_stream = await litellm.acompletion(
-                model="openrouter/google/gemini-2.0-flash-exp:free", # Primary choice
-                messages=conversation,
-                stream=True,
-                fallbacks=[ # Add your desired fallbacks here
-                    {"model": "gemini/gemini-2.0-flash-exp"},
-                    {"model": "claude-3-5-sonnet-20240620"}
-                ]
-            )
-
-            # Process the stream from LiteLLM for the blog text
+            litellm = _get_litellm()
+            async with _llm_semaphore:
+                response_stream = await litellm.acompletion(
+                    model="openrouter/google/gemini-2.0-flash-exp:free", # Primary choice
+                    messages=conversation,
+                    stream=True,
+                    fallbacks=[ # Add your desired fallbacks here
+                        {"model": "gemini/gemini-2.0-flash-exp"},
+                        {"model": "claude-3-5-sonnet-20240620"}
+                    ]
+                )
+
+            # Process the stream from LiteLLM for the blog text. The model
+            # appends a {"images": [...]} block at the very end, which is
+            # for us, not the reader — hold back a small tail so the block
+            # never reaches the client, even if it spans chunk boundaries.
+            pending = ""
+            in_keyword_block = False
             async for chunk in response_stream:
                 token = chunk.choices[0].delta.content or ""
-                if token:
-                    full_blog_text += token
-                    yield token # Yield initial text chunks
-            
-            # --- After full blog text is received, generate image keywords and embed images ---
-            print("\n🔍 Generating image keywords from blog content...")
-            # Use another LiteLLM call to get structured keywords based on the generated text
-            keyword_generation_prompt = {
-                "role": "user",
-                "content": f"Extract 3-5 concise, general keywords related to the main theme of the following blog post for image search. Provide them as a JSON array, e.g., '{{\"keywords\": [\"keyword1\", \"keyword2\"]}}'.\n\nBlog Post:\n{full_blog_text[:1000]}" # Send a snippet to save tokens
-            }
-
-            try:
-                keyword_response = await litellm.acompletion(
-                    model="openrouter/google/gemini-2.0-flash-exp:free", # Or any other suitable model
-                    messages=[
-    {"role": "system", "content": "You are a helpful assistant that extracts keywords as a JSON array."},
-    keyword_generation_prompt
-],
-                    response_model={"keywords": list[str]}, # Use response_model for structured output
-                    stream=False # Do not stream keyword response
-                )
-                image_keywords = keyword_response.choices[0].message.content.get("keywords", [])
-                print(f"🖼️ Extracted keywords: {image_keywords}")
+                if not token:
+                    continue
+                blog_parts.append(token)
+                if in_keyword_block:
+                    continue
+                pending += token
+                marker_at = pending.find(_IMAGES_MARKER)
+                if marker_at != -1:
+                    in_keyword_block = True
+                    if marker_at:
+                        yield pending[:marker_at]
+                    pending = ""
+                else:
+                    safe = len(pending) - (len(_IMAGES_MARKER) - 1)
+                    if safe > 0:
+                        yield pending[:safe]
+                        pending = pending[safe:]
+            if pending and not in_keyword_block:
+                yield pending
+
+            # Join once — repeated += on a long string is quadratic in the
+            # worst case, a list of tokens joins in linear time.
+            full_blog_text = "".join(blog_parts)
+
+            # --- Parse the inline keywords block appended by the model ---
+            image_keywords = []
+            block_match = _IMAGES_BLOCK.search(full_blog_text)
+            if block_match:
+                try:
+                    image_keywords = _json_loads(block_match.group()).get("images", [])
+                except ValueError as e:
+                    logger.warning("Error parsing inline keywords block: %s", e)
+                # Keep the keyword block out of paragraph splitting and the cache
+                full_blog_text = full_blog_text[:block_match.start()].rstrip()
+            if not image_keywords:
+                # Model skipped the block; extract keywords locally from the
+                # text itself, with the raw prompt as a last resort
+                image_keywords = extract_fallback_keywords(full_blog_text) or user_prompt.split()[:3]
+                logger.info("Using fallback keywords: %s", image_keywords)
+            logger.info("🖼️ Extracted keywords: %s", image_keywords)
 
-            except Exception as e:
-                print(f"Error generating image keywords: {e}")
-                # Fallback to using the initial prompt if keyword extraction fails
-                image_keywords = user_prompt.split()[:3] # Simple split for fallback
-                print(f"Using fallback keywords: {image_keywords}")
+            image_urls = await prepare_images(image_keywords)
 
-            # --- Fetch and embed images ---
+            # --- Embed images ---
             if image_keywords:
                 # Decide how many images to embed and where.
                 # For simplicity, let's fetch one image per keyword up to 3 images,
                 # and try to insert them after roughly every 3 paragraphs.
-                
+
                 # Split the blog content into paragraphs
-                paragraphs = re.split(r'\n\s*\n', full_blog_text) # Split by one or more blank lines
-                embedded_blog_parts = []
+                paragraphs = _PARAGRAPH_SPLIT.split(full_blog_text)
                 image_count = 0
-                max_images_to_insert = 2 # Limit the number of images to insert for demonstration
 
+                # The text itself has already been streamed, so only the
+                # image markdown needs to go over the wire — no need to
+                # rebuild and re-slice the whole post just to find it.
                 for i, paragraph in enumerate(paragraphs):
-                    embedded_blog_parts.append(paragraph)
-
-                    if image_count < max_images_to_insert and (i + 1) % 3 == 0 and image_keywords and len(image_keywords) > image_count:
-                        keyword_for_image = image_keywords[image_count]
-                        image_url = fetch_single_image(keyword_for_image)
-                        if image_url:
-                            # Yield the Markdown for the image
-                            image_markdown = f'\n\n![{keyword_for_image.replace("_", " ").title()}]({image_url})\n\n'
-                            embedded_blog_parts.append(image_markdown)
-                            image_count += 1
-                        else:
-                            print(f"Failed to fetch image for '{keyword_for_image}'.")
-                
-                # If images were appended, they are now part of embedded_blog_parts.
-                # Join and yield the final content.
-                final_content_with_images = "\n\n".join(embedded_blog_parts)
-                # Yield any remaining content that includes the embedded images
-                # This will re-yield some content, but ensures images are sent after text
-                yield final_content_with_images[len(full_blog_text):] # Yield only the new image markdown added
-                
-                print("✅ Images embedded into blog content.")
+                    if image_count < len(image_urls) and (i + 1) % 3 == 0:
+                        # Alt text from the matching keyword where there is one
+                        keyword_for_image = image_keywords[min(image_count, len(image_keywords) - 1)]
+                        image_url = image_urls[image_count]
+                        # Yield the Markdown for the image
+                        image_markdown = f'\n\n![{keyword_for_image.replace("_", " ").title()}]({image_url})\n\n'
+                        yield image_markdown
+                        inserted_images += image_markdown
+                        image_count += 1
+
+                logger.info("✅ Images embedded into blog content.")
             else:
-                print("❌ No keywords to fetch images or Pexels API key missing.")
+                logger.info("❌ No keywords to fetch images or Pexels API key missing.")
 
+            # Cache the finished post so the same prompt is served instantly.
+            # Skip the write when we wanted images but got none (e.g. a
+            # transient Pexels error) — the blog cache has no TTL, so
+            # caching here would pin an image-less post and defeat the
+            # retry-on-failure policy of the Pexels cache.
+            if image_urls or not image_keywords:
+                _blog_cache[cache_key] = full_blog_text + inserted_images
+                if len(_blog_cache) > _BLOG_CACHE_MAX_ENTRIES:
+                    _blog_cache.pop(next(iter(_blog_cache)))
 
         except Exception as e:
             # This will catch errors if all fallback models fail or during image processing
-            print(f"Error in stream_generator: {e}")
+            logger.exception("Error in stream_generator: %s", e)
             error_message = f'\n**Error:** An issue occurred during blog or image generation. Details: {str(e)}'
             yield error_message
             return
 
-    # Return the StreamingResponse with the async generator
-    return StreamingResponse(stream_generator(), media_type="text/plain")
+    # Return the StreamingResponse with the async generator, as SSE so
+    # proxies deliver tokens as they are generated instead of buffering
+    return StreamingResponse(
+        sse_events(stream_generator()),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Connection": "keep-alive",
+        },
+    )
 
 if __name__ == "__main__":
     import uvicorn
     # Make sure to set your PEXELS_API_KEY and OPENROUTER_API_KEY (or GEMINI_API_KEY)
     # in your .env file or as environment variables.
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # The app is passed as an import string so uvicorn can spawn worker
+    # processes (one event loop per core). uvloop/httptools shave
+    # per-request loop overhead; fall back to uvicorn's defaults wherever
+    # they aren't installed (e.g. Windows, where uvloop has no wheels).
+    try:
+        import uvloop
+        loop_impl = "uvloop"
+    except ImportError:
+        loop_impl = "auto"
+    try:
+        import httptools
+        http_impl = "httptools"
+    except ImportError:
+        http_impl = "auto"
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop=loop_impl,
+        http=http_impl,
+    )
\ No newline at end of file
@@ -295,12 +295,26 @@ export default function BlogAgent() {
       const reader = res.body.getReader();
       const decoder = new TextDecoder();
       let fullReceivedMarkdown = ""; // Accumulates all streamed markdown, including images
+      let sseBuffer = ""; // Holds a partial SSE event between reads
 
       while (true) {
         const { done, value } = await reader.read();
         if (done) break;
-        const chunk = decoder.decode(value);
-        fullReceivedMarkdown += chunk;
+        // Backend streams SSE: each event is "data: {\"token\": \"...\"}\n\n"
+        sseBuffer += decoder.decode(value, { stream: true });
+        const events = sseBuffer.split("\n\n");
+        sseBuffer = events.pop() ?? ""; // Last piece may be incomplete
+        for (const event of events) {
+          for (const line of event.split("\n")) {
+            if (line.startsWith("data: ")) {
+              try {
+                fullReceivedMarkdown += JSON.parse(line.slice(6)).token ?? "";
+              } catch {
+                // Skip malformed events rather than breaking the stream
+              }
+            }
+          }
+        }
         setStreamingBlog(fullReceivedMarkdown); // Update streaming display directly
       }
 